@@ -1,17 +1,32 @@
 from __future__ import annotations
 import json
+import asyncio
 import datetime as dt
+import hashlib
+import io
+import logging
 import os
-from typing import Any, Dict, List
+import queue
+import re
+import unicodedata
+import uuid
+import threading
+import time
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+from functools import cache, lru_cache
+from typing import TYPE_CHECKING, Any, AsyncIterator, Awaitable, Callable, Dict, List
 
-import gspread
-from google.oauth2.service_account import Credentials as SACredentials
-from googleapiclient.discovery import build
 from dotenv import load_dotenv
-from flask import Flask, request
-import requests
-from google import genai
-from google.genai import types
+from quart import Quart, request
+import httpx
+import orjson
+from cachetools import TTLCache
+from tenacity import retry, retry_if_exception, stop_after_attempt, wait_random_exponential
+
+if TYPE_CHECKING:
+    import gspread
+    from google.oauth2.service_account import Credentials as SACredentials
 
 # -------------------------------------------------------------
 # 環境変数ロード
@@ -21,29 +36,311 @@ GEMINI_API_KEY = os.getenv("GEMINI_API_KEY")
 LINE_CHANNEL_ACCESS_TOKEN = os.getenv("LINE_CHANNEL_ACCESS_TOKEN")
 CREDENTIALS_JSON = os.environ["CREDENTIALS_JSON"]
 SHARED_DRIVE_ID = os.getenv("SHARED_DRIVE_ID")  # Secret に登録しておく
+MODEL_TEXT = os.getenv("GEMINI_MODEL_TEXT", "gemini-1.5-flash")
+MODEL_VISION = os.getenv("GEMINI_MODEL_VISION", "gemini-1.5-pro-latest")
+MODEL_VISION_LITE = os.getenv("GEMINI_MODEL_VISION_LITE", "gemini-1.5-flash")  # 時間枠の読み取りなど粗い解析用
+
+# ログは logging 経由で出す（% 形式の引数は実際に出力するときだけ文字列にする）
+logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s")
+log = logging.getLogger("linebot")
 
 # ----------------------------------------
-# Gemini 初期化
+# Gemini 初期化（SDK の import は初回利用時まで遅らせる）
 # ----------------------------------------
-client = genai.Client(api_key=GEMINI_API_KEY)
+@cache
+def _gemini():
+    from google import genai
+    return genai.Client(api_key=GEMINI_API_KEY)
 
 # ----------------------------------------
-# Drive ＆ gspread 認証（サービスアカウント）
+# 外部 API の一時的な失敗（429 / 5xx / 通信エラー）はジッター付きの指数バックオフで数回だけやり直す
 # ----------------------------------------
-sa_info = json.loads(CREDENTIALS_JSON)
-creds = SACredentials.from_service_account_info(
-    sa_info, scopes=["https://www.googleapis.com/auth/drive", "https://www.googleapis.com/auth/spreadsheets"]
+RETRY_ATTEMPTS = 3
+
+def _is_transient(e: BaseException) -> bool:
+    if isinstance(e, httpx.TransportError):
+        return True
+    if isinstance(e, httpx.HTTPStatusError):
+        status = e.response.status_code
+    else:
+        status = getattr(e, "code", None)  # google.genai.errors.APIError
+    return isinstance(status, int) and (status == 429 or status >= 500)
+
+retry_transient = retry(
+    retry=retry_if_exception(_is_transient),
+    stop=stop_after_attempt(RETRY_ATTEMPTS),
+    wait=wait_random_exponential(multiplier=0.5, max=8),
+    reraise=True,
 )
-drive = build("drive", "v3", credentials=creds)
-gc = gspread.authorize(creds)  # 直接 creds を渡せるメソッド
 
-app = Flask(__name__)
-user_state: Dict[str, Dict[str, Any]] = {}
+# Gemini が続けて失敗しているときは、しばらく呼ばずにすぐ失敗させる（障害中に待ちを積み上げない）
+GEMINI_BREAKER_FAILS = 10
+GEMINI_BREAKER_RESET_SEC = 30
+_gemini_fails = 0
+_gemini_open_until = 0.0  # ループ上でだけ触る
+
+class GeminiUnavailable(Exception):
+    pass
+
+def _gemini_circuit_check() -> None:
+    if time.monotonic() < _gemini_open_until:
+        raise GeminiUnavailable("Gemini の呼び出しを一時停止中")
+
+def _gemini_circuit_record(ok: bool) -> None:
+    global _gemini_fails, _gemini_open_until
+    if ok:
+        _gemini_fails = 0
+        return
+    _gemini_fails += 1
+    if _gemini_fails >= GEMINI_BREAKER_FAILS:
+        log.warning("[_gemini_circuit_record] %s consecutive failures, pausing %ss", _gemini_fails, GEMINI_BREAKER_RESET_SEC)
+        _gemini_fails = 0
+        _gemini_open_until = time.monotonic() + GEMINI_BREAKER_RESET_SEC
+
+# 同時に投げる Gemini リクエストの上限（バーストで 429 を招いて再試行に時間を取られないように）
+GEMINI_MAX_CONCURRENCY = int(os.getenv("GEMINI_MAX_CONCURRENCY", "8"))
+_gemini_sem = asyncio.Semaphore(GEMINI_MAX_CONCURRENCY)
+
+@retry_transient
+async def _gemini_generate_retrying(**kwargs):
+    async with _gemini_sem:  # 再試行の待ち時間中は枠を空けておく
+        return await _gemini().aio.models.generate_content(**kwargs)
+
+@retry_transient
+async def _gemini_stream_retrying(**kwargs):
+    """
+    ストリームを開くところまでを再試行する（途中まで受け取った応答はやり直さない）。
+    _gemini_sem は受信し終えるまで呼び出し側で持つ
+    """
+    return await _gemini().aio.models.generate_content_stream(**kwargs)
+
+async def _gemini_generate(**kwargs):
+    """generate_content に再試行と遮断をかけたもの"""
+    _gemini_circuit_check()
+    try:
+        res = await _gemini_generate_retrying(**kwargs)
+    except Exception as e:
+        if _is_transient(e):  # 400 / 403 などこちら側の誤りでは止めない
+            _gemini_circuit_record(False)
+        raise
+    _gemini_circuit_record(True)
+    return res
+
+# ----------------------------------------
+# Drive ＆ gspread 認証（サービスアカウント）
+# ----------------------------------------
+SCOPES = ["https://www.googleapis.com/auth/drive", "https://www.googleapis.com/auth/spreadsheets"]
+
+@cache
+def _creds() -> SACredentials:
+    """鍵の JSON パースと RSA 鍵の読み込みはプロセスで 1 回だけ"""
+    from google.oauth2.service_account import Credentials as SACredentials
+    return SACredentials.from_service_account_info(orjson.loads(CREDENTIALS_JSON), scopes=SCOPES)
+
+@cache
+def _drive():
+    from googleapiclient.discovery import build
+    return build("drive", "v3", credentials=_creds())
+
+@cache
+def _gc() -> gspread.Client:
+    """Sheets への接続を keep-alive で使い回す（並列の書き込みに足りる数だけプールする）"""
+    import gspread
+    from google.auth.transport.requests import AuthorizedSession
+    from requests.adapters import HTTPAdapter
+    session = AuthorizedSession(_creds())
+    session.mount("https://", HTTPAdapter(pool_connections=4, pool_maxsize=32))
+    return gspread.Client(auth=_creds(), session=session)
+
+CREDS_REFRESH_MARGIN_SEC = 10 * 60  # 有効期限のこれだけ前に更新する
+CREDS_RETRY_SEC = 60
+
+def _refresh_creds_periodically() -> None:
+    """
+    起動時にトークンを取得しておき、以後は有効期限の少し前に裏で更新する。
+    ユーザー向けの Sheets / Drive 呼び出しがトークン更新を踏まないようにするため。
+    """
+    from google.auth.transport.requests import Request as GoogleAuthRequest
+    creds = _creds()
+    try:
+        creds.refresh(GoogleAuthRequest())
+        # google-auth の expiry は naive な UTC
+        left = (creds.expiry - dt.datetime.utcnow()).total_seconds()
+        delay = max(CREDS_RETRY_SEC, left - CREDS_REFRESH_MARGIN_SEC)
+    except Exception as e:
+        log.warning("[_refresh_creds_periodically] exception=%s", e)
+        delay = CREDS_RETRY_SEC
+    _schedule_creds_refresh(delay)
+
+def _schedule_creds_refresh(delay: float) -> None:
+    timer = threading.Timer(delay, _refresh_creds_periodically)
+    timer.daemon = True
+    timer.start()
+
+app = Quart(__name__)
+# webhook の本文は数 KB。大きすぎる本文は読み込む前に 413 で断る（イベントが多い配信でも収まる上限）
+app.config["MAX_CONTENT_LENGTH"] = 256 * 1024
+
+@app.before_serving
+async def _start_creds_refresh() -> None:
+    """
+    初回のトークン取得も裏で行い、起動を Google への通信で待たせない。
+    スレッドは fork を越えて引き継がれないので、import 時ではなく各ワーカーの起動時に始める（preload 対応）
+    """
+    _schedule_creds_refresh(0)
+
+# ----------------------------------------
+# ユーザーごとの会話状態（しばらく操作のないユーザーは自動で消える）
+# REDIS_URL があれば Redis に置く（複数ワーカーで共有でき、再起動でも消えない）。
+# 状態を書き換えたら必ず _state_save で保存すること。
+# ----------------------------------------
+USER_STATE_MAX = 10_000
+USER_STATE_TTL_SEC = int(os.getenv("USER_STATE_TTL_SEC", str(24 * 3600)))  # 作成したシートの URL もここにあるので 1 日は持つ
+REDIS_URL = os.getenv("REDIS_URL")
+
+@cache
+def _redis():
+    """redis.asyncio のクライアント。サーバーのイベントループ上でだけ使う"""
+    import redis.asyncio as redis
+    return redis.Redis(connection_pool=redis.BlockingConnectionPool.from_url(REDIS_URL, max_connections=32))
+
+class MemorySessionStore:
+    """イベントループ上でだけ触るのでロック不要"""
+    def __init__(self) -> None:
+        self._states: TTLCache = TTLCache(maxsize=USER_STATE_MAX, ttl=USER_STATE_TTL_SEC)
+
+    async def get(self, uid: str) -> Dict[str, Any] | None:
+        return self._states.get(uid)
+
+    async def save(self, uid: str, st: Dict[str, Any]) -> None:
+        self._states[uid] = st
+
+    async def touch(self, uid: str) -> Dict[str, Any] | None:
+        """get と同じだが、あれば TTL を延長する（TTLCache は入れ直すと期限が延びる）"""
+        st = self._states.get(uid)
+        if st is not None:
+            self._states[uid] = st
+        return st
+
+# 状態の持ち方を変えたら上げる（古い形式のキーは読まれなくなり、TTL で消える）
+SESSION_KEY_VERSION = "v1"
+
+def _session_key(uid: str, kind: str = "state") -> str:
+    return f"{SESSION_KEY_VERSION}:{kind}:{uid}"
+
+class RedisSessionStore:
+    """ユーザーごとの hash に 1 項目ずつ保存する。bytes（画像）はそのまま、それ以外は JSON で持つ"""
+    BINARY_FIELDS = {"template_img"}
+
+    async def get(self, uid: str) -> Dict[str, Any] | None:
+        return self._decode(await _redis().hgetall(_session_key(uid)))
+
+    async def touch(self, uid: str) -> Dict[str, Any] | None:
+        """get と同じだが、あれば TTL を延長する（中身は書き直さず、1 往復で済ませる）"""
+        key = _session_key(uid)
+        async with _redis().pipeline(transaction=False) as pipe:
+            pipe.hgetall(key)
+            pipe.expire(key, USER_STATE_TTL_SEC)
+            data, _ = await pipe.execute()
+        return self._decode(data)
+
+    def _decode(self, data: Dict[bytes, bytes]) -> Dict[str, Any] | None:
+        if not data:
+            return None
+        st = {}
+        for k, v in data.items():
+            k = k.decode()
+            st[k] = v if k in self.BINARY_FIELDS else orjson.loads(v)
+        return st
+
+    async def save(self, uid: str, st: Dict[str, Any]) -> None:
+        key = _session_key(uid)
+        mapping = {k: v if isinstance(v, bytes) else orjson.dumps(v) for k, v in st.items()}
+        async with _redis().pipeline() as pipe:  # MULTI/EXEC で消した項目ごと丸ごと置き換える
+            pipe.delete(key)
+            pipe.hset(key, mapping=mapping)
+            pipe.expire(key, USER_STATE_TTL_SEC)
+            await pipe.execute()
+
+sessions = RedisSessionStore() if REDIS_URL else MemorySessionStore()
+
+async def _state_get(uid: str) -> Dict[str, Any] | None:
+    return await sessions.get(uid)
+
+async def _state_save(uid: str, st: Dict[str, Any]) -> None:
+    await sessions.save(uid, st)
+
+async def _state_touch(uid: str) -> Dict[str, Any]:
+    """状態を取得（なければ作成）し、TTL を延長する。既にある状態は書き直さない（変えたら各処理が _state_save する）"""
+    st = await sessions.touch(uid)
+    if st is None:
+        st = {"step": "start"}
+        await sessions.save(uid, st)
+    return st
+
+USER_LOCK_TIMEOUT_SEC = 30
+
+@asynccontextmanager
+async def _user_lock(uid: str) -> AsyncIterator[None]:
+    """
+    Redis 利用時は、同じユーザーの状態の読み書きをワーカーをまたいで直列化する（取れなければ LockError）。
+    プロセス内の状態は await をまたがずに読み書きするので何もしない
+    """
+    if not REDIS_URL:
+        yield
+        return
+    lock = _redis().lock(
+        _session_key(uid, "lock"), timeout=USER_LOCK_TIMEOUT_SEC, blocking_timeout=USER_LOCK_TIMEOUT_SEC
+    )
+    async with lock:
+        yield
+
+async def _state_update(uid: str, step: str, changes: Dict[str, Any], drop: tuple[str, ...] = ()) -> bool:
+    """
+    裏で走るジョブの結果を状態に書き戻す。ジョブの間に別のイベントで会話が進んでいたら
+    （step が step でなくなっていたら）上書きせずに False を返す
+    """
+    async with _user_lock(uid):
+        st = await _state_get(uid)
+        if not st or st.get("step") != step:
+            return False
+        st.update(changes)
+        for k in drop:
+            st.pop(k, None)
+        await _state_save(uid, st)
+        return True
+
+# ----------------------------------------
+# 裏で走らせるタスク（webhook の応答や返信を待たせない処理）
+# ----------------------------------------
+MAX_PENDING_EVENTS = 1000  # 実行中のタスクがこれを超えたら 503 で断る（2xx 以外なら LINE 側が再送する）
+_tasks: set[asyncio.Task] = set()
+
+def _spawn(coro: Awaitable[Any]) -> asyncio.Task:
+    """完了まで参照を持っておく（create_task の戻り値を捨てると途中で GC されうる）"""
+    task = asyncio.ensure_future(coro)
+    _tasks.add(task)
+    task.add_done_callback(_tasks.discard)
+    return task
 
 # ----------------------------------------
 # マスターシート取得
 # ----------------------------------------
+_master_ws: gspread.Worksheet | None = None
+_master_lock = threading.Lock()
+
 def _get_master_ws() -> gspread.Worksheet:
+    global _master_ws
+    if _master_ws is not None:
+        return _master_ws
+    with _master_lock:
+        if _master_ws is None:
+            _master_ws = _open_master_ws()
+    return _master_ws
+
+def _open_master_ws() -> gspread.Worksheet:
+    import gspread
+    gc = _gc()
     try:
         ws = gc.open("契約店舗一覧").sheet1
     except gspread.SpreadsheetNotFound:
@@ -52,27 +349,75 @@ def _get_master_ws() -> gspread.Worksheet:
         ws.append_row(["店舗名","店舗ID","座席数","シートURL","登録日時","時間枠"])
     return ws
 
+# 店舗ID はマスターシートの最大値の続きから連番で振る（Redis があればワーカー間で共有）
+STORE_ID_BASE = 100000
+NEXT_STORE_ID_KEY = "next_store_id"
+_last_store_id: int | None = None
+_store_id_lock = asyncio.Lock()
+
+async def _next_store_id() -> int:
+    """マスターシートを読むのはプロセスで 1 回だけ（「店舗ID」列 = B 列）"""
+    global _last_store_id
+    async with _store_id_lock:
+        if _last_store_id is None:
+            col = await asyncio.to_thread(lambda: _get_master_ws().col_values(2))
+            ids = [int(v) for v in col[1:] if str(v).isdigit()]
+            _last_store_id = max(ids, default=STORE_ID_BASE)
+            if REDIS_URL:
+                await _redis().set(NEXT_STORE_ID_KEY, _last_store_id, nx=True)
+        if REDIS_URL:
+            return int(await _redis().incr(NEXT_STORE_ID_KEY))
+        _last_store_id += 1
+        return _last_store_id
+
+SHEET_KEY_RE = re.compile(r"/spreadsheets/d/([a-zA-Z0-9-_]+)")
+
+def _sheet_key(sheet_url: str) -> str:
+    m = SHEET_KEY_RE.search(sheet_url)
+    return m.group(1) if m else sheet_url
+
+@lru_cache(maxsize=128)
+def _open_ws(sheet_key: str) -> gspread.Worksheet:
+    """
+    店舗ごとの予約表。同じ店舗から続けて画像が届いても開くのは 1 回だけ。
+    URL の表記ゆれ（/edit, ?usp=... など）で別物扱いにならないよう ID で引く。
+    """
+    return _gc().open_by_key(sheet_key).sheet1
+
+def _forget_ws(e: Exception) -> None:
+    """シートが消された・共有が外れたときは開いたハンドルを捨てる（lru_cache は 1 件だけ消せないので全体）"""
+    status = getattr(getattr(e, "response", None), "status_code", None)
+    if status in (401, 403, 404):
+        _open_ws.cache_clear()
+
 # ファイル冒頭あたりに
 PARENT_FOLDER_ID = os.getenv("PARENT_FOLDER_ID")
 
 # ----------------------------------------
 # 予約表スプレッドシート作成
 # ----------------------------------------
+SHEET_HEADER = ["月","日","時間帯","名前","人数","備考"]
+
+def _row_data(values: List[str]) -> Dict[str, Any]:
+    return {"values": [{"userEnteredValue": {"stringValue": v}} if v else {} for v in values]}
+
 def create_store_sheet(name, store_id, seat_info, times):
-    # 1) My Driveにシート作成
-    file = drive.files().create(
-        body={
-            "name": f"予約表 - {name} ({store_id})",
-            "mimeType": "application/vnd.google-apps.spreadsheet",
+    # 1) ヘッダーと時間枠を入れた状態でシート作成（Sheets API 1 回）
+    rows = [SHEET_HEADER] + [[ "", "", t, "", "", "" ] for t in times]
+    created = _gc().request(
+        "post",
+        "https://sheets.googleapis.com/v4/spreadsheets",
+        json={
+            "properties": {"title": f"予約表 - {name} ({store_id})"},
+            "sheets": [{"data": [{"startRow": 0, "startColumn": 0, "rowData": [_row_data(r) for r in rows]}]}],
         },
-        fields="id, webViewLink"
-    ).execute()
-    sheet_id = file["id"]
-    sheet_url = file["webViewLink"]
+    ).json()
+    sheet_id = created["spreadsheetId"]
+    sheet_url = created["spreadsheetUrl"]
 
     # 2) 共有フォルダに移動
     PARENT_FOLDER_ID = os.getenv("PARENT_FOLDER_ID")
-    drive.files().update(
+    _drive().files().update(
         fileId=sheet_id,
         addParents=PARENT_FOLDER_ID,
         removeParents="root",
@@ -80,17 +425,70 @@ def create_store_sheet(name, store_id, seat_info, times):
         fields="id, parents"
     ).execute()
 
-    # 3) gspread で開いて初期行セット...
-    ws = gc.open_by_url(sheet_url).sheet1
-    ws.update([["月","日","時間帯","名前","人数","備考"]])
-    if times:
-        ws.append_rows([[ "", "", t, "", "", "" ] for t in times], value_input_option="USER_ENTERED")
-
-    # 4) マスターへ登録...
-    master = _get_master_ws()
-    master.append_row([name, store_id, seat_info, sheet_url, dt.datetime.now().isoformat(), ",".join(times)])
+    # 4) マスターへ登録...（ユーザーへの返信を待たせないよう、まとめて裏で書き込む）
+    _enqueue_master_row([name, store_id, seat_info, sheet_url, dt.datetime.now().isoformat(), ",".join(times)])
     return sheet_url
 
+# マスターシートへの追記は MASTER_FLUSH_SEC の間に届いた分を 1 回の append_rows にまとめる
+MASTER_FLUSH_SEC = 5
+MASTER_FLUSH_MAX = 500
+MASTER_STOP_SEC = 8  # 停止時に残りの行を書き切るのを待つ上限
+_master_queue: queue.Queue = queue.Queue()  # None は書き込み用スレッドの停止の合図
+_master_flusher: threading.Thread | None = None
+_master_flusher_lock = threading.Lock()
+
+def _enqueue_master_row(row: List[Any]) -> None:
+    """書き込み用スレッドは最初の登録時に起動する"""
+    global _master_flusher
+    _master_queue.put(row)
+    with _master_flusher_lock:
+        if _master_flusher is None:
+            _master_flusher = threading.Thread(target=_flush_master_rows, name="linebot-master", daemon=True)
+            _master_flusher.start()
+
+def _flush_master_rows() -> None:
+    """書けなかった行は捨てずに持っておき、次の回にまとめて書き直す"""
+    rows: List[List[Any]] = []
+    stopping = False
+    while not stopping:
+        # 持ち越した行があれば MASTER_FLUSH_SEC 後に書き直す。なければ次の登録まで待つ
+        deadline = time.monotonic() + MASTER_FLUSH_SEC if rows else None
+        while len(rows) < MASTER_FLUSH_MAX:
+            left = None if deadline is None else deadline - time.monotonic()
+            if left is not None and left <= 0:
+                break
+            try:
+                row = _master_queue.get(timeout=left)
+            except queue.Empty:
+                break
+            if row is None:
+                stopping = True
+                break
+            rows.append(row)
+            if deadline is None:
+                deadline = time.monotonic() + MASTER_FLUSH_SEC
+        if not rows:
+            continue
+        try:
+            _get_master_ws().append_rows(rows)
+            rows = []
+        except Exception as e:
+            log.warning("[_flush_master_rows] exception=%s pending=%s", e, len(rows))
+            if len(rows) >= MASTER_FLUSH_MAX and not stopping:
+                time.sleep(MASTER_FLUSH_SEC)
+    if rows:
+        # 手で登録し直せるよう、書けなかった行はそのままログに残す
+        log.error("[_flush_master_rows] unsaved rows=%s", rows)
+
+def _stop_master_flusher(timeout: float) -> None:
+    """キューに残っている登録を書き切ってから書き込み用スレッドを止める"""
+    with _master_flusher_lock:
+        flusher = _master_flusher
+    if flusher is None:
+        return
+    _master_queue.put(None)
+    flusher.join(timeout)
+
 # -------------------------------------------------------------
 # 予約情報追記
 # -------------------------------------------------------------
@@ -98,251 +496,928 @@ def append_reservations(
     sheet_url: str,
     rows: List[Dict[str, Any]]
 ) -> None:
-    sh = gc.open_by_url(sheet_url)
-    ws = sh.sheet1
-    values = [
-        [
+    """
+    テンプレートから作った空き枠（時間帯だけ入っていて名前が空の行）があればそこへ書き込み、
+    残りは末尾に追記する。読み取りは 1 回（_free_slots）、書き込みは最大 2 回。
+    """
+    ws = _open_ws(_sheet_key(sheet_url))
+    values = []
+    seen = set()  # Vision が同じ行を二重に読んだ分は送らない
+    for r in rows:
+        key = (r.get("month"), r.get("day"), r.get("time"), r.get("name"))
+        if key in seen:
+            continue
+        seen.add(key)
+        values.append([
             r.get("month", ""),
             r.get("day", ""),
             r.get("time", ""),
             r.get("name", ""),
             r.get("size", ""),
             r.get("note", "")
-        ]
-        for r in rows
-    ]
-    if values:
-        ws.append_rows(values, value_input_option="USER_ENTERED")
+        ])
+    if not values:
+        return
+
+    try:
+        # 空き枠は書く直前に毎回読み直す（店舗の手入力や別ワーカーの書き込みで埋まった行を上書きしない）。
+        # 同じプロセス内で同じシートへ並行して書く分は、読んでから書き終えるまでを直列にする
+        with _sheet_lock(_sheet_key(sheet_url)):
+            free_slots = _free_slots(ws)
+            updates: List[Dict[str, Any]] = []
+            new_rows: List[List[Any]] = []
+            for v in values:
+                slots = free_slots.get(str(v[2]))
+                if slots:
+                    r = slots.pop(0)
+                    updates.append({"range": f"A{r}:F{r}", "values": [v]})
+                else:
+                    new_rows.append(v)
+            if updates:
+                ws.batch_update(updates, value_input_option="USER_ENTERED")
+            if new_rows:
+                ws.append_rows(new_rows, value_input_option="USER_ENTERED")
+    except Exception as e:
+        _forget_ws(e)
+        raise
+
+_sheet_locks: Dict[str, threading.Lock] = {}  # 店舗のシートの数だけしか増えない
+_sheet_locks_lock = threading.Lock()
+
+def _sheet_lock(sheet_key: str) -> threading.Lock:
+    with _sheet_locks_lock:
+        return _sheet_locks.setdefault(sheet_key, threading.Lock())
+
+def _free_slots(ws: gspread.Worksheet) -> Dict[str, List[int]]:
+    """時間帯 -> 空き枠の行番号（上から順）"""
+    # 列の並びは create_store_sheet で固定なので、ヘッダーは読まずに C 列（時間帯）と D 列（名前）だけを取得する
+    slots: Dict[str, List[int]] = {}
+    for i, row in enumerate(ws.get("C2:D"), start=2):
+        slot_time, name = (row + ["", ""])[:2]
+        if slot_time and not name:
+            slots.setdefault(slot_time, []).append(i)
+    return slots
 
 # -------------------------------------------------------------
 # LINE メッセージ送受信
 # -------------------------------------------------------------
-def _line_reply(token: str, text: str) -> None:
-    requests.post(
-        "https://api.line.me/v2/bot/message/reply",
-        headers={
-            "Authorization": f"Bearer {LINE_CHANNEL_ACCESS_TOKEN}",
-            "Content-Type": "application/json"
-        },
-        json={"replyToken": token, "messages": [{"type": "text", "text": text}]},
-        timeout=10
+@cache
+def _line_aio() -> httpx.AsyncClient:
+    """
+    LINE API 用の共有クライアント（keep-alive + HTTP/2 で 1 本の接続に多重化）。サーバーのイベントループ上でだけ使う。
+    transport を渡すとクライアント側の limits / http2 は無視されるので transport に指定する。
+    """
+    return httpx.AsyncClient(
+        headers={"Authorization": f"Bearer {LINE_CHANNEL_ACCESS_TOKEN}"},
+        transport=httpx.AsyncHTTPTransport(
+            http2=True,
+            limits=httpx.Limits(max_connections=32, max_keepalive_connections=16),
+            retries=2,
+        ),
     )
 
-def _line_push(uid: str, text: str) -> None:
-    requests.post(
-        "https://api.line.me/v2/bot/message/push",
-        headers={
-            "Authorization": f"Bearer {LINE_CHANNEL_ACCESS_TOKEN}",
-            "Content-Type": "application/json"
-        },
-        json={"to": uid, "messages": [{"type": "text", "text": text}]},
-        timeout=10
+LINE_MAX_MESSAGES = 5     # reply / push 1 回あたりのメッセージ上限
+REPLY_WAIT_SEC = 45       # replyToken の有効期限（約 1 分）より手前で打ち切る
+
+# 固定の返信文
+MSG_ASK_STORE_NAME = "店舗名を送ってください。"
+MSG_RETRY_STORE_NAME = "店舗名をもう一度送ってください。"
+MSG_ASK_SEATS = "座席数を入力してください（例：1人席:3 2人席:2 4人席:1）"
+MSG_RETRY_SEATS = "座席数を再度入力してください。"
+MSG_ASK_TEMPLATE = "テンプレート画像をお送りください。解析後にシートを作成します。"
+MSG_RETRY_TEMPLATE = "テンプレート画像を再度お送りください。"
+MSG_CREATING_SHEET = "シートを作成中です…"
+MSG_TEMPLATE_RECEIVED = "画像を受信しました。解析中…"
+MSG_FILLED_RECEIVED = "画像を受信しました。予約情報を抽出中…"
+MSG_IMAGE_UNEXPECTED = "現在この画像は処理できません。"
+MSG_DESCRIBE_FAILED = "画像解析に失敗しました。もう一度鮮明な画像をお送りください。"
+MSG_ROWS_NOT_FOUND = "予約情報が検出できませんでした。もう一度鮮明な画像を送ってください。"
+MSG_APPEND_FAILED = "予約情報の追記に失敗しました。再度お試しください。"
+MSG_INTERNAL_ERROR = "内部エラーが発生しました。再度お試しください。"
+MSG_VISION_BUSY = "画像の解析が混み合っています。しばらくしてから画像を再度お送りください。"
+
+# 値を差し込む返信文
+REPLY_CONFIRM_STORE = "登録完了：店舗名：{name}\n店舗ID：{sid}\nこの内容でよろしいですか？（はい／いいえ）"
+REPLY_CONFIRM_SEATS = "座席数確認：{seat_info}\nこの内容で登録しますか？（はい／いいえ）"
+REPLY_CONFIRM_TEMPLATE = "{desc}\n\nこの内容でスプレッドシートを作成してよろしいですか？（はい／いいえ）"
+REPLY_SHEET_CREATED = "✅ シート作成完了！ {url}\n記入済みの画像を送ってください。"
+REPLY_ROWS_APPENDED = "✅ 予約情報を追記しました！ 最新シート: {url}"
+REPLY_ROWS_PARTIAL = "⚠️ 画像の解析が途中で止まったため、読み取れた {n} 件だけ追記しました。シート: {url}\n残りはシートを確認のうえ、画像を再度お送りください。"
+
+def _line_messages(texts: tuple[str, ...]) -> List[Dict[str, str]]:
+    return [{"type": "text", "text": t} for t in texts[:LINE_MAX_MESSAGES]]
+
+async def _line_post(path: str, body: Dict[str, Any]) -> None:
+    headers = {"Content-Type": "application/json"}
+    if path == "push":
+        # 再試行で同じメッセージが二重に届かないよう、送信 1 回ごとに固定の再試行キーを付ける
+        headers["X-Line-Retry-Key"] = str(uuid.uuid4())
+    try:
+        await _line_send(path, orjson.dumps(body), headers)  # json= は標準の json.dumps を通るので自前でシリアライズする
+    except httpx.HTTPError as e:
+        log.warning("[_line_post] %s error=%s", path, e)
+
+@retry_transient
+async def _line_send(path: str, content: bytes, headers: Dict[str, str]) -> None:
+    r = await _line_aio().post(
+        f"https://api.line.me/v2/bot/message/{path}", content=content, headers=headers, timeout=10
     )
+    r.raise_for_status()
+
+async def _line_reply(token: str, *texts: str) -> None:
+    await _line_post("reply", {"replyToken": token, "messages": _line_messages(texts)})
+
+async def _line_push(uid: str, *texts: str) -> None:
+    await _line_post("push", {"to": uid, "messages": _line_messages(texts)})
+
+async def _run_job(job, *args) -> List[str]:
+    """job(*args) が返すメッセージ。失敗したら内部エラーの返信文"""
+    try:
+        return await job(*args)
+    except Exception as e:
+        log.warning("[_run_job] %s error=%s", job.__name__, e)
+        return [MSG_INTERNAL_ERROR]
+
+async def _reply_with_result(uid: str, token: str, ack: str, job, *args) -> None:
+    """
+    job(*args) が返すメッセージを ack と同じ reply にまとめて送る。
+    REPLY_WAIT_SEC 以内に終わらなければ ack だけ reply し、結果は push で送る。
+    """
+    task = asyncio.ensure_future(_run_job(job, *args))
+    try:
+        result = await asyncio.wait_for(asyncio.shield(task), REPLY_WAIT_SEC)
+    except asyncio.TimeoutError:
+        await _line_reply(token, ack)
+        result = await task
+        if result:
+            await _line_push(uid, *result)
+        return
+    await _line_reply(token, ack, *result)
+
+async def _push_result(uid: str, job, *args) -> None:
+    """ack は呼び出し側で先に reply 済み。job(*args) の結果は push で送る"""
+    result = await _run_job(job, *args)
+    if result:
+        await _line_push(uid, *result)
 
 # -------------------------------------------------------------
 # 画像ダウンロード
 # -------------------------------------------------------------
-def _download_line_img(msg_id: str) -> bytes:
-    r = requests.get(
+IMAGE_CHUNK_SIZE = 64 * 1024
+
+@retry_transient
+async def _download_line_img(msg_id: str) -> io.BytesIO:
+    """本文は少しずつ BytesIO に書き込み、そのまま Pillow に渡す（レスポンス全体のコピーを別に持たない）"""
+    buf = io.BytesIO()
+    async with _line_aio().stream(
+        "GET",
         f"https://api-data.line.me/v2/bot/message/{msg_id}/content",
-        headers={"Authorization": f"Bearer {LINE_CHANNEL_ACCESS_TOKEN}"},
         timeout=15
-    )
-    r.raise_for_status()
-    return r.content
+    ) as r:
+        r.raise_for_status()
+        async for chunk in r.aiter_bytes(IMAGE_CHUNK_SIZE):
+            buf.write(chunk)
+    buf.seek(0)
+    return buf
+
+IMAGE_MAX_EDGE = 1280        # 手書き行の読み取りに必要な解像度
+TIMES_IMAGE_MAX_EDGE = 768   # 時間枠の読み取りは表の構造が分かれば足りる
+IMAGE_JPEG_QUALITY = 80
+
+def _preprocess_image(raw: bytes | io.BytesIO, max_edge: int = IMAGE_MAX_EDGE) -> bytes:
+    """
+    長辺を max_edge に縮小して JPEG で再圧縮する（Vision のトークン数と転送量を減らす）。
+    スマホ写真の EXIF の向きは画素に反映してから捨てる（横倒しのまま読ませない）。
+    """
+    from PIL import Image, ImageOps
+    src = raw if isinstance(raw, io.BytesIO) else io.BytesIO(raw)
+    try:
+        with Image.open(src) as im:
+            if im.format == "JPEG" and max(im.size) <= max_edge and not im.info.get("exif"):
+                return src.getvalue()  # 縮小不要な JPEG は再エンコードせず画質と CPU を節約
+            im = ImageOps.exif_transpose(im).convert("RGB")
+            im.thumbnail((max_edge, max_edge), Image.LANCZOS)
+            buf = io.BytesIO()
+            im.save(buf, "JPEG", quality=IMAGE_JPEG_QUALITY, optimize=True)
+    except Exception as e:
+        log.warning("[_preprocess_image] exception=%s", e)
+        return src.getvalue()
+    return buf.getvalue()
 
 # -------------------------------------------------------------
 # 画像解析・要約
 # -------------------------------------------------------------
-def _vision_describe_sheet(img: bytes) -> str:
-    prompt = (
-        "画像は、手書きで記入するための予約表です。\n"
-        "以下のように簡潔に構成をまとめてください：\n"
-        "- 表のタイトル\n"
-        "- 日付欄\n"
-        "- 列の構成（時間帯、名前、人数、備考など）\n"
-        "- 注意書きの内容\n"
-        "- テーブル番号の使い分け"
-    )
+def _image_contents(img: bytes | str, prompt: str | None = None):
+    """
+    画像 1 枚（＋指示文）の contents。画像のパートは呼び出し 1 回につき 1 度だけ組み立てる。
+    img が str なら File API に上げ済みの画像の URI として参照する。
+    """
+    from google.genai import types
+    if isinstance(img, str):
+        parts = [types.Part.from_uri(file_uri=img, mime_type="image/jpeg")]
+    else:
+        parts = [types.Part.from_bytes(data=img, mime_type="image/jpeg")]
+    if prompt:
+        parts.append(types.Part.from_text(text=prompt))
+    return types.Content(parts=parts)
+
+async def _upload_image(img: bytes) -> str | None:
+    """
+    Gemini の File API に画像を上げて URI を返す（Gemini 側で 48 時間保持される）。
+    後で使う画像を状態にバイト列で持たずに済む。失敗したら None
+    """
     try:
-        res = client.models.generate_content(
-            model=MODEL_VISION,
-            contents=types.Content(parts=[
-                types.Part.from_bytes(data=img, mime_type="image/jpeg"),
-                types.Part.from_text(text=prompt)
-            ]),
-            config=types.GenerateContentConfig(max_output_tokens=1024)
-        )
-        return res.text.strip()
+        f = await _gemini().aio.files.upload(file=io.BytesIO(img), config={"mime_type": "image/jpeg"})
+        return f.uri
+    except Exception as e:
+        log.warning("[_upload_image] exception=%s", e)
+        return None
+
+# 同じ画像の再送（二度押しや LINE の再送）で Vision を呼び直さないよう、結果を
+# モデル + 指示文 + 画像 の SHA-256 で覚えておく。GEMINI_CACHE_VERSION を変えれば一斉に無効化できる。
+# REDIS_URL があれば Redis に置き、ワーカー間・再起動後も使い回す。
+GEMINI_CACHE_VERSION = "v1"
+GEMINI_CACHE_TTL_SEC = 7 * 24 * 3600
+_gemini_cache: TTLCache = TTLCache(maxsize=512, ttl=GEMINI_CACHE_TTL_SEC)  # ループ上でだけ触る
+
+def _gemini_cache_key(model: str, prompt: str, img: bytes) -> str:
+    h = hashlib.sha256(f"{model}\0{prompt}\0".encode())
+    h.update(img)
+    return f"gemini:{GEMINI_CACHE_VERSION}:{h.hexdigest()}"
+
+async def _gemini_cache_get(key: str) -> Any:
+    if REDIS_URL:
+        raw = await _redis().get(key)
+        return orjson.loads(raw) if raw is not None else None
+    return _gemini_cache.get(key)
+
+async def _gemini_cache_put(key: str, value: Any) -> None:
+    if REDIS_URL:
+        await _redis().set(key, orjson.dumps(value), ex=GEMINI_CACHE_TTL_SEC)
+        return
+    _gemini_cache[key] = value
+
+DESCRIBE_PROMPT = (
+    "画像は、手書きで記入するための予約表です。\n"
+    "以下のように簡潔に構成をまとめてください：\n"
+    "- 表のタイトル\n"
+    "- 日付欄\n"
+    "- 列の構成（時間帯、名前、人数、備考など）\n"
+    "- 注意書きの内容\n"
+    "- テーブル番号の使い分け"
+)
+DESCRIBE_MAX_TOKENS = 1024
+
+@cache
+def _describe_config():
+    from google.genai import types
+    return types.GenerateContentConfig(max_output_tokens=DESCRIBE_MAX_TOKENS)
+
+async def _vision_describe_sheet(img: bytes) -> str:
+    key = _gemini_cache_key(MODEL_VISION, DESCRIBE_PROMPT, img)
+    try:
+        desc = await _gemini_cache_get(key)
+        if desc is None:
+            res = await _gemini_generate(
+                model=MODEL_VISION,
+                contents=_image_contents(img, DESCRIBE_PROMPT),
+                config=_describe_config()
+            )
+            desc = res.text.strip()
+            if desc:
+                await _gemini_cache_put(key, desc)
+        return desc or MSG_DESCRIBE_FAILED
+    except GeminiUnavailable:
+        return MSG_VISION_BUSY
     except Exception as e:
-        print(f"[_vision_describe_sheet] exception={e}")
-        return "画像解析に失敗しました。もう一度鮮明な画像をお送りください。"
+        log.warning("[_vision_describe_sheet] exception=%s", e)
+        return MSG_DESCRIBE_FAILED
+
+def _parse_json_list(text: str, key: str) -> List[Any]:
+    """
+    {key: [...]} / [...] のどちらでも配列を取り出す。
+    形は response_schema で保証されるので、読めないときは握りつぶさずログに残して空を返す。
+    """
+    try:
+        data = orjson.loads(text)
+    except ValueError as e:
+        log.warning("[_parse_json_list] %s invalid json error=%s text=%r", key, e, text[:200])
+        return []
+    if isinstance(data, dict):
+        data = data.get(key, [])
+    return data if isinstance(data, list) else []
+
+TIMES_SCHEMA = {
+    "type": "OBJECT",
+    "properties": {"times": {"type": "ARRAY", "items": {"type": "STRING"}}},
+    "required": ["times"],
+}
+
+TIMES_PROMPT = (
+    "画像は空欄の飲食店予約表です。\n"
+    "予約可能な時間帯 (HH:MM) を、左上→右下の順に重複なく昇順で {\"times\": [...]} の形で返してください。"
+)
+TIMES_MAX_TOKENS = 256
 
-def _vision_extract_times(img: bytes) -> List[str]:
-    prompt = (
-        "画像は空欄の飲食店予約表です。\n"
-        "予約可能な時間帯 (HH:MM) を、左上→右下の順に重複なく昇順で JSON 配列として返してください。"
+@cache
+def _times_config():
+    from google.genai import types
+    return types.GenerateContentConfig(
+        response_mime_type="application/json",
+        response_schema=TIMES_SCHEMA,
+        max_output_tokens=TIMES_MAX_TOKENS,
+        temperature=0.0,
     )
+
+async def _vision_extract_times(img: bytes | str, key: str) -> List[str]:
+    """
+    img は TIMES_IMAGE_MAX_EDGE に縮小済みの画像（またはその File API の URI）。
+    URI からはキャッシュキーを作れないので、縮小版から作ったキーを key で受け取る。
+    """
     try:
-        res = client.models.generate_content(
-            model=MODEL_VISION,
-            contents=types.Content(parts=[
-                types.Part.from_bytes(data=img, mime_type="image/jpeg"),
-                types.Part.from_text(text=prompt)
-            ]),
-            config=types.GenerateContentConfig(max_output_tokens=256)
-        )
-        data = json.loads(res.text)
-        return data if isinstance(data, list) else []
+        times = await _gemini_cache_get(key)
+        if times is None:
+            res = await _gemini_generate(
+                model=MODEL_VISION_LITE,
+                contents=_image_contents(img, TIMES_PROMPT),
+                config=_times_config()
+            )
+            times = [str(t) for t in _parse_json_list(res.text, "times")]
+            if times:
+                await _gemini_cache_put(key, times)
+        return times
     except Exception as e:
-        print(f"[_vision_extract_times] exception={e}")
+        log.warning("[_vision_extract_times] exception=%s", e)
         return []
 
-def _vision_extract_rows(img: bytes) -> List[Dict[str, Any]]:
-    prompt = (
-        "画像は手書きの予約表です。各行の予約情報を JSON 配列で返してください。\n"
-        "形式: [{\"month\":int,\"day\":int,\"time\":\"HH:MM\",\"name\":str,\"size\":int,\"note\":str}]"
+ROWS_INSTRUCTION = "画像は手書きの予約表です。記入済みの各行の予約情報を抽出してください。時間は HH:MM 形式。"
+ROWS_BATCH_INSTRUCTION = ROWS_INSTRUCTION + "複数の画像が送られるので、画像ごとに配列を分けて送られた順に並べてください。"
+ROWS_SCHEMA = {
+    "type": "ARRAY",
+    "items": {
+        "type": "OBJECT",
+        "properties": {
+            "month": {"type": "INTEGER"},
+            "day": {"type": "INTEGER"},
+            "time": {"type": "STRING"},
+            "name": {"type": "STRING"},
+            "size": {"type": "INTEGER"},
+            "note": {"type": "STRING"},
+        },
+        "required": ["month", "day", "time", "name", "size"],
+    },
+}
+
+ROWS_MAX_TOKENS = 2048
+
+@cache
+def _rows_config(n_images: int = 1):
+    """n_images > 1 は複数画像をまとめて解析するとき（画像ごとの配列の配列で返させる）"""
+    from google.genai import types
+    if n_images == 1:
+        return types.GenerateContentConfig(
+            system_instruction=ROWS_INSTRUCTION,
+            response_mime_type="application/json",
+            response_schema=ROWS_SCHEMA,
+            max_output_tokens=ROWS_MAX_TOKENS,
+            temperature=0.0,
+        )
+    return types.GenerateContentConfig(
+        system_instruction=ROWS_BATCH_INSTRUCTION,
+        response_mime_type="application/json",
+        response_schema={"type": "ARRAY", "items": ROWS_SCHEMA},
+        max_output_tokens=ROWS_MAX_TOKENS * n_images,
+        temperature=0.0,
     )
+
+ROWS_FLUSH_SIZE = 25  # ストリーミング中、この行数たまるごとにシートへ書き込む
+RowsSink = Callable[[List[Dict[str, Any]]], Awaitable[None]]
+_json_decoder = json.JSONDecoder()
+
+def _take_json_array_items(buf: str, pos: int) -> tuple[List[Any], int]:
+    """
+    JSON 配列の途中までのテキスト buf から、pos 以降の閉じた要素を取り出す。
+    次に読む位置も返す（pos < 0 は配列の開始をまだ見つけていない状態）。
+    """
+    if pos < 0:
+        start = buf.find("[")
+        if start < 0:
+            return [], -1
+        pos = start + 1
+    items: List[Any] = []
+    while True:
+        while pos < len(buf) and buf[pos] in " \r\n\t,":
+            pos += 1
+        if pos >= len(buf) or buf[pos] == "]":
+            break
+        try:
+            item, pos = _json_decoder.raw_decode(buf, pos)
+        except json.JSONDecodeError:
+            break  # 要素の途中。次の断片を待つ
+        items.append(item)
+    return items, pos
+
+RowsResult = tuple[List[Dict[str, Any]], bool]  # (読めた行, 応答を最後まで受け取れたか)
+
+async def _vision_extract_rows(img: bytes, on_rows: RowsSink | None = None) -> RowsResult:
+    """
+    応答をストリーミングで受け、on_rows があれば ROWS_FLUSH_SIZE 行ごとに渡す。
+    on_rows には最終的に読めた全行が渡る。途中で切れたときは complete=False で、それまでの行を返す。
+    """
+    rows: List[Dict[str, Any]] = []
+    flushed = 0
+    complete = False
+    try:
+        _gemini_circuit_check()
+        async with _gemini_sem:
+            stream = await _gemini_stream_retrying(
+                model=MODEL_VISION,
+                contents=_image_contents(img),
+                config=_rows_config()
+            )
+            buf, pos = "", -1
+            async for chunk in stream:
+                buf += chunk.text or ""
+                items, pos = _take_json_array_items(buf, pos)
+                rows.extend(row for row in items if isinstance(row, dict))
+                if on_rows and len(rows) - flushed >= ROWS_FLUSH_SIZE:
+                    await on_rows(rows[flushed:])
+                    flushed = len(rows)
+        _gemini_circuit_record(True)
+        complete = True
+    except Exception as e:
+        if _is_transient(e):
+            _gemini_circuit_record(False)
+        log.warning("[_vision_extract_rows] exception=%s", e)
+    if on_rows and len(rows) > flushed:
+        await on_rows(rows[flushed:])
+    return rows, complete
+
+# 同時期に届いた記入済み画像はまとめて 1 回の Vision 呼び出しで解析する
+ROWS_BATCH_MAX = 4
+ROWS_BATCH_WAIT_SEC = 1.0
+_rows_batches: Dict[str, Dict[str, Any]] = {}  # シートごとの集め途中のバッチ。ループ上でだけ触るのでロック不要
+
+async def _vision_extract_rows_multi(imgs: List[bytes]) -> List[List[Dict[str, Any]]] | None:
+    from google.genai import types
+    parts = []
+    for i, img in enumerate(imgs, 1):
+        parts.append(types.Part.from_text(text=f"画像{i}"))
+        parts.append(types.Part.from_bytes(data=img, mime_type="image/jpeg"))
     try:
-        res = client.models.generate_content(
+        res = await _gemini_generate(
             model=MODEL_VISION,
-            contents=types.Content(parts=[
-                types.Part.from_bytes(data=img, mime_type="image/jpeg"),
-                types.Part.from_text(text=prompt)
-            ]),
-            config=types.GenerateContentConfig(max_output_tokens=2048)
+            contents=types.Content(parts=parts),
+            config=_rows_config(len(imgs))
         )
-        data = json.loads(res.text)
-        return data if isinstance(data, list) else []
+        data = _parse_json_list(res.text, "per_image")
     except Exception as e:
-        print(f"[_vision_extract_rows] exception={e}")
+        log.warning("[_vision_extract_rows_multi] exception=%s", e)
+        return None
+    if len(data) != len(imgs):
+        return None
+    return [rows if isinstance(rows, list) else [] for rows in data]
+
+async def _vision_extract_rows_batched(
+    img: bytes, batch_key: str, on_rows: RowsSink | None = None
+) -> RowsResult:
+    """
+    最初に来た呼び出し（リーダー）が ROWS_BATCH_WAIT_SEC だけ後続を待ち、まとめて解析する。
+    まとめるのは batch_key（書き込み先のシート）が同じ画像だけ。応答の並びが入れ替わっても別の店舗のシートには書かない。
+    まとめた呼び出しが失敗したら 1 枚ずつ（ストリーミングで）解析し直す。
+    on_rows の扱いは _vision_extract_rows と同じ。
+    """
+    fut: asyncio.Future = asyncio.get_running_loop().create_future()
+    batch = _rows_batches.get(batch_key)
+    leader = batch is None
+    if leader:
+        batch = _rows_batches[batch_key] = {"items": [], "full": asyncio.Event()}
+    batch["items"].append((img, on_rows, fut))
+    if len(batch["items"]) >= ROWS_BATCH_MAX:
+        _rows_batches.pop(batch_key, None)
+        batch["full"].set()
+    if not leader:
+        return await fut
+
+    items = batch["items"]
+    try:
+        try:
+            await asyncio.wait_for(batch["full"].wait(), ROWS_BATCH_WAIT_SEC)
+        except asyncio.TimeoutError:
+            pass
+        if _rows_batches.get(batch_key) is batch:
+            del _rows_batches[batch_key]
+        multi = await _vision_extract_rows_multi([i for i, _, _ in items]) if len(items) > 1 else None
+        if multi is None:
+            results = await asyncio.gather(*(_vision_extract_rows(i, sink) for i, sink, _ in items))
+        else:
+            results = [(rows, True) for rows in multi]
+            for (_, sink, f), rows in zip(items, multi):
+                if sink and rows and not f.done():
+                    await sink(rows)
+        for (_, _, f), result in zip(items, results):
+            if not f.done():  # 後続の呼び出しが取り消されると、その future も取り消し済みになっている
+                f.set_result(result)
+    finally:
+        # リーダーが取り消されたり途中で失敗したりしても、後続を待たせたままにしない
+        if _rows_batches.get(batch_key) is batch:
+            del _rows_batches[batch_key]
+        for _, _, f in items:
+            if not f.done():
+                f.set_result(([], False))
+    return await fut
+
+async def _vision_extract_rows_cached(
+    img: bytes, batch_key: str, on_rows: RowsSink | None = None
+) -> RowsResult:
+    """同じ画像を解析済みなら Vision を呼ばずに前回の行を返す（on_rows の扱いは _vision_extract_rows と同じ）"""
+    key = _gemini_cache_key(MODEL_VISION, ROWS_INSTRUCTION, img)
+    rows = await _gemini_cache_get(key)
+    if rows is not None:
+        if on_rows and rows:
+            await on_rows(rows)
+        return rows, True
+    rows, complete = await _vision_extract_rows_batched(img, batch_key, on_rows)
+    if rows and complete:  # 途中で切れた応答を覚えると、送り直しても同じ欠けた結果が返り続ける
+        await _gemini_cache_put(key, rows)
+    return rows, complete
+
+# -------------------------------------------------------------
+# OCR 高速パス（任意）
+# 活字で書かれた予約表なら Tesseract だけで読めるので Vision を呼ばない。
+# tesseract 本体と jpn の学習データが必要なため OCR_FASTPATH=1 のときだけ有効。
+# -------------------------------------------------------------
+OCR_FASTPATH = os.getenv("OCR_FASTPATH") == "1"
+OCR_MIN_CONFIDENCE = 70  # 単語の平均信頼度がこれ未満なら Vision に回す
+OCR_ROW_RE = re.compile(r"(\d{1,2})[:：](\d{2})\s+(\S+)\s+(\d{1,2})\s*名?\s*(.*)")
+OCR_DATE_RE = re.compile(r"(\d{1,2})\s*[月/]\s*(\d{1,2})")
+
+def _ocr_extract_rows(img: bytes) -> List[Dict[str, Any]]:
+    """読めた行が 1 行以上かつ信頼度が十分なときだけ行を返す。それ以外は空リスト"""
+    try:
+        import pytesseract
+        from PIL import Image
+        with Image.open(io.BytesIO(img)) as im:
+            # Tesseract は 1 回だけ回す。本文の行も単語ごとの結果から組み立てる
+            data = pytesseract.image_to_data(im, lang="jpn+eng", output_type=pytesseract.Output.DICT)
+    except Exception as e:
+        log.warning("[_ocr_extract_rows] exception=%s", e)
         return []
+    confs = [float(c) for c in data.get("conf", []) if float(c) >= 0]
+    if not confs or sum(confs) / len(confs) < OCR_MIN_CONFIDENCE:
+        return []
+
+    lines: Dict[tuple, List[str]] = {}  # (ブロック, 段落, 行) -> 単語（出てきた順 = 上から順）
+    for block, par, line, word in zip(data["block_num"], data["par_num"], data["line_num"], data["text"]):
+        if word.strip():
+            lines.setdefault((block, par, line), []).append(word)
+    text = unicodedata.normalize("NFKC", "\n".join(" ".join(words) for words in lines.values()))
+    date = OCR_DATE_RE.search(text)
+    month, day = (int(date.group(1)), int(date.group(2))) if date else ("", "")
+    rows = []
+    for line in text.splitlines():
+        m = OCR_ROW_RE.search(line)
+        if m:
+            rows.append({
+                "month": month, "day": day, "time": f"{int(m.group(1)):02d}:{m.group(2)}",
+                "name": m.group(3), "size": int(m.group(4)), "note": m.group(5).strip(),
+            })
+    return rows
 
-def _process_template(uid: str, msg_id: str) -> None:
-    st = user_state.get(uid)
+async def _process_template(uid: str, msg_id: str) -> List[str]:
+    st = await _state_get(uid)
     if not st or st.get("step") != "wait_template_img":
-        return
-    img = _download_line_img(msg_id)
-    desc = _vision_describe_sheet(img)
-    if "失敗しました" in desc:
-        _line_push(uid, desc)
-        return
-    st.update({"template_img": img, "step": "confirm_template"})
-    _line_push(uid, f"{desc}\n\nこの内容でスプレッドシートを作成してよろしいですか？（はい／いいえ）")
+        return []
+    img = await asyncio.to_thread(_preprocess_image, await _download_line_img(msg_id))
+    small = await asyncio.to_thread(_preprocess_image, img, TIMES_IMAGE_MAX_EDGE)
+    # 時間枠の読み取り用の縮小版は、構成の要約を待つ間に File API へ上げておき状態には URI だけ残す
+    desc, uri = await asyncio.gather(_vision_describe_sheet(img), _upload_image(small))
+    if desc in (MSG_DESCRIBE_FAILED, MSG_VISION_BUSY):
+        return [desc]
+    changes: Dict[str, Any] = {
+        "step": "confirm_template",
+        "times_key": _gemini_cache_key(MODEL_VISION_LITE, TIMES_PROMPT, small),
+    }
+    if uri:
+        changes["template_uri"] = uri
+        drop = ("template_img",)
+    else:
+        changes["template_img"] = small  # アップロードに失敗したときはバイト列のまま持つ
+        drop = ("template_uri",)
+    if not await _state_update(uid, "wait_template_img", changes, drop):
+        return []
+    return [REPLY_CONFIRM_TEMPLATE.format(desc=desc)]
 
-def _process_filled(uid: str, msg_id: str) -> None:
-    st = user_state.get(uid)
+async def _process_filled(uid: str, msg_id: str) -> List[str]:
+    st = await _state_get(uid)
     if not st or st.get("step") != "wait_filled_img":
-        return
-    img = _download_line_img(msg_id)
-    rows = _vision_extract_rows(img)
+        return []
+    img = await asyncio.to_thread(_preprocess_image, await _download_line_img(msg_id))
+    sheet_url = st["sheet_url"]
+    errors: List[Exception] = []
+
+    async def write(chunk: List[Dict[str, Any]]) -> None:
+        if errors:
+            return
+        try:
+            await asyncio.to_thread(append_reservations, sheet_url, chunk)
+        except Exception as e:
+            log.warning("[_process_filled] error=%s", e)
+            errors.append(e)
+
+    rows = await asyncio.to_thread(_ocr_extract_rows, img) if OCR_FASTPATH else []
+    complete = True
+    if rows:
+        await write(rows)
+    else:
+        rows, complete = await _vision_extract_rows_cached(img, _sheet_key(sheet_url), write)
+    if errors:
+        return [MSG_APPEND_FAILED]
     if not rows:
-        _line_push(uid, "予約情報が検出できませんでした。もう一度鮮明な画像を送ってください。")
-        return
+        # 解析自体が失敗（遮断中を含む）したときは画像のせいにせず、時間をおいて送り直してもらう
+        return [MSG_ROWS_NOT_FOUND if complete else MSG_VISION_BUSY]
+    if not complete:
+        # 途中までの行は書き込み済み。全部読めたことにはせず、step もそのまま（送り直しを受け付ける）
+        return [REPLY_ROWS_PARTIAL.format(n=len(rows), url=sheet_url)]
+    await _state_update(uid, "wait_filled_img", {"step": "done"})
+    return [REPLY_ROWS_APPENDED.format(url=sheet_url)]
+
+async def _create_sheet_for(uid: str) -> List[str]:
+    """_on_confirm_template が step を creating_sheet にしてから呼ぶ（作成中の「はい」で二重に作らない）"""
+    st = await _state_get(uid)
+    if not st or st.get("step") != "creating_sheet":
+        return []
     try:
-        append_reservations(st["sheet_url"], rows)
-    except Exception as e:
-        print(f"[_process_filled] error={e}")
-        _line_push(uid, "予約情報の追記に失敗しました。再度お試しください。")
+        # times_key のない状態は template_img だけを持っていた以前の形式（デプロイ前から確認待ちだったユーザー）
+        key = st.get('times_key') or _gemini_cache_key(MODEL_VISION_LITE, TIMES_PROMPT, st['template_img'])
+        times = await _vision_extract_times(st.get('template_uri') or st['template_img'], key)
+        url = await asyncio.to_thread(
+            create_store_sheet, st['store_name'], st['store_id'], st['seat_info'], times
+        )
+    except Exception:
+        await _state_update(uid, "creating_sheet", {'step': 'confirm_template'})  # もう一度「はい」で作り直せるように
+        raise
+    if not await _state_update(
+        uid, "creating_sheet", {'step': 'wait_filled_img', 'sheet_url': url},
+        drop=('template_uri', 'template_img', 'times_key', 'creating_at'),  # 画像はもう使わないので手放す
+    ):
+        return []
+    return [REPLY_SHEET_CREATED.format(url=url)]
+
+# -------------------------------------------------------------
+# はい／いいえ 判定
+# -------------------------------------------------------------
+YES_RE = re.compile(r"はい|了解|大丈夫|お願い|いいよ|よろしく|(?<![a-z])ok(?![a-z])", re.IGNORECASE)
+# 「大丈夫じゃない」「よろしくないです」のような打ち消しは、肯定の語を含んでいても「いいえ」とみなす（「じゃあ」は除く）
+NO_RE = re.compile(r"いいえ|違う|ちがう|やめ|キャンセル|ダメ|だめ|修正|ない|ません|じゃ(?![あぁ])|(?<![a-z])ng(?![a-z])", re.IGNORECASE)
+
+def _is_yes(text: str) -> bool:
+    return bool(YES_RE.search(text)) and not NO_RE.search(text)
+
+# -------------------------------------------------------------
+# 店舗名・座席数の読み取り（Gemini を呼ばずに手元で処理）
+# -------------------------------------------------------------
+STORE_NAME_PREFIX_RE = re.compile(r"^(店舗名|店名|お店の名前)\s*[:：は]?\s*")
+# 席の種類と数の間は短い区切りだけ（「2人席なし、4人席1」で次の「4人席」の 4 を拾わない）
+SEAT_RE = re.compile(r"(\d+)\s*人\s*(?:席|掛け|がけ)[^\d人]{0,6}?(\d+)(?!\d|\s*人)")
+JUNK_RE = re.compile(r"(?:はい|いいえ|ok|yes|no|[\s。、!?.])*", re.IGNORECASE)  # 「はい」「ok」などの相づちだけの入力
+# 店舗名として受け付けない返事。「凛」のような短い店名もあるので、句読点を除いたメッセージ全体が一致するときだけ
+FILLER_WORDS = frozenset({"はい", "いいえ", "ok", "yes", "no"})
+FILLER_TRAILING_PUNCT = " 。、.,!?~ー"
+
+def _is_filler(text: str) -> bool:
+    t = unicodedata.normalize("NFKC", text).strip().rstrip(FILLER_TRAILING_PUNCT).casefold()
+    return t in FILLER_WORDS
+
+def _is_junk(text: str) -> bool:
+    """短すぎる・相づちだけの入力は座席数として読みようがない（Gemini にも送らない）"""
+    t = unicodedata.normalize("NFKC", text).strip()
+    return len(t) < 2 or bool(JUNK_RE.fullmatch(t))
+
+def _parse_store_name(text: str) -> str:
+    line = unicodedata.normalize("NFKC", text).strip().splitlines()[0] if text.strip() else ""
+    return STORE_NAME_PREFIX_RE.sub("", line).strip()[:40]
+
+def _parse_seats(text: str) -> str:
+    """「１人席３つ、４人席は１」のような入力を「1人席:3 4人席:1」形式にそろえる。読めなければ空文字"""
+    seats: Dict[int, int] = {}
+    for size, count in SEAT_RE.findall(unicodedata.normalize("NFKC", text)):
+        seats[int(size)] = int(count)
+    return " ".join(f"{size}人席:{seats[size]}" for size in sorted(seats))
+
+SEATS_PROMPT = "以下の文から座席数を抽出し、形式「1人席:◯ 2人席:◯ 4人席:◯」で出力してください：\n"
+SEATS_MAX_TOKENS = 128
+
+@cache
+def _seats_config():
+    from google.genai import types
+    return types.GenerateContentConfig(max_output_tokens=SEATS_MAX_TOKENS)
+
+async def _gemini_format_seats(text: str) -> str:
+    """同じ入力の送り直し（いいえ → 同じ文をもう一度、など）では Gemini を呼ばない"""
+    prompt = SEATS_PROMPT + unicodedata.normalize("NFKC", text).strip()
+    key = _gemini_cache_key(MODEL_TEXT, prompt, b"")
+    seat_info = await _gemini_cache_get(key)
+    if seat_info is None:
+        res = await _gemini_generate(model=MODEL_TEXT, contents=prompt, config=_seats_config())
+        seat_info = res.text.strip()
+        if seat_info:
+            await _gemini_cache_put(key, seat_info)
+    return seat_info
+
+# -------------------------------------------------------------
+# 会話ステップごとの処理（step -> 関数の表で振り分ける）
+# -------------------------------------------------------------
+async def _on_start(uid: str, token: str, st: Dict[str, Any], text: str) -> None:
+    name = "" if _is_filler(text) else _parse_store_name(text)
+    if not name:
+        await _line_reply(token, MSG_ASK_STORE_NAME)
         return
-    _line_push(uid, f"✅ 予約情報を追記しました！ 最新シート: {st['sheet_url']}")
-    st['step'] = 'done'
+    sid = await _next_store_id()
+    st.update({"step": "confirm_store", "store_name": name, "store_id": sid})
+    await _state_save(uid, st)
+    await _line_reply(token, REPLY_CONFIRM_STORE.format(name=name, sid=sid))
 
-def _handle_event(event: Dict[str, Any]) -> None:
-    try:
-        if event.get("type") != "message":
+async def _on_confirm_store(uid: str, token: str, st: Dict[str, Any], text: str) -> None:
+    if _is_yes(text):
+        st['step'] = 'ask_seats'
+        await _state_save(uid, st)
+        await _line_reply(token, MSG_ASK_SEATS)
+    else:
+        st.update({'step': 'start'})
+        await _state_save(uid, st)
+        await _line_reply(token, MSG_RETRY_STORE_NAME)
+
+async def _on_ask_seats(uid: str, token: str, st: Dict[str, Any], text: str) -> None:
+    # 書式どおりでない入力だけ Gemini に整形を任せる。相づちや短すぎる入力は呼ばずに聞き直す
+    seat_info = _parse_seats(text)
+    if not seat_info:
+        if _is_junk(text):
+            await _line_reply(token, MSG_ASK_SEATS)
             return
+        seat_info = await _gemini_format_seats(text)
+    st.update({'step': 'confirm_seats', 'seat_info': seat_info})
+    await _state_save(uid, st)
+    await _line_reply(token, REPLY_CONFIRM_SEATS.format(seat_info=seat_info))
+
+async def _on_confirm_seats(uid: str, token: str, st: Dict[str, Any], text: str) -> None:
+    if _is_yes(text):
+        st['step'] = 'wait_template_img'
+        await _state_save(uid, st)
+        await _line_reply(token, MSG_ASK_TEMPLATE)
+    else:
+        st['step'] = 'ask_seats'
+        await _state_save(uid, st)
+        await _line_reply(token, MSG_RETRY_SEATS)
+
+async def _on_confirm_template(uid: str, token: str, st: Dict[str, Any], text: str) -> None:
+    if _is_yes(text):
+        # 作成には時間がかかるので先に受け付けを返し、URL はできあがってから push で送る
+        st.update({'step': 'creating_sheet', 'creating_at': time.time()})
+        await _state_save(uid, st)
+        await _line_reply(token, MSG_CREATING_SHEET)
+        _spawn(_push_result(uid, _create_sheet_for, uid))
+    else:
+        st.update({'step': 'wait_template_img'})
+        await _state_save(uid, st)
+        await _line_reply(token, MSG_RETRY_TEMPLATE)
+
+SHEET_CREATE_STALE_SEC = 300  # これより長く作成中のままなら、再起動などで作成が途切れたとみなす
+
+async def _on_creating_sheet(uid: str, token: str, st: Dict[str, Any], text: str) -> None:
+    if time.time() - st.get('creating_at', 0) > SHEET_CREATE_STALE_SEC:
+        await _on_confirm_template(uid, token, st, text)
+        return
+    await _line_reply(token, MSG_CREATING_SHEET)
+
+TEXT_STEPS: Dict[str, Callable[[str, str, Dict[str, Any], str], Awaitable[None]]] = {
+    "start": _on_start,
+    "confirm_store": _on_confirm_store,
+    "ask_seats": _on_ask_seats,
+    "confirm_seats": _on_confirm_seats,
+    "confirm_template": _on_confirm_template,
+    "creating_sheet": _on_creating_sheet,
+}
+
+# 画像を受け付けるステップ -> (受信の返信, 解析ジョブ)
+IMAGE_STEPS: Dict[str, tuple[str, Callable[[str, str], Awaitable[List[str]]]]] = {
+    "wait_template_img": (MSG_TEMPLATE_RECEIVED, _process_template),
+    "wait_filled_img": (MSG_FILLED_RECEIVED, _process_filled),
+}
+
+async def _handle_event(event: Dict[str, Any]) -> None:
+    """event は webhook() で返信可能なメッセージイベントに絞り込み済み"""
+    try:
         uid = event["source"]["userId"]
         token = event.get("replyToken", "")
         msg = event["message"]
         mtype = msg.get("type")
-        text = msg.get("text", "")
-        msg_id = msg.get("id", "")
-        st = user_state.setdefault(uid, {"step": "start"})
+        st = await _state_touch(uid)
         step = st.get("step")
 
         if mtype == "text":
-            if step == "start":
-                resp = client.models.generate_content(
-                    model=MODEL_TEXT,
-                    contents=types.Content(parts=[
-                        types.Part.from_text(text=f"以下の文から店舗名だけを抽出してください：\n{text}")
-                    ]),
-                    config=types.GenerateContentConfig(max_output_tokens=64)
-                )
-                name = resp.text.strip()
-                sid = random.randint(100000, 999999)
-                st.update({"step": "confirm_store", "store_name": name, "store_id": sid})
-                _line_reply(token, f"登録完了：店舗名：{name}\n店舗ID：{sid}\nこの内容でよろしいですか？（はい／いいえ）")
-                return
-            if step == "confirm_store":
-                if "はい" in text:
-                    st['step'] = 'ask_seats'
-                    _line_reply(token, "座席数を入力してください（例：1人席:3 2人席:2 4人席:1）")
-                else:
-                    st.update({'step': 'start'})
-                    _line_reply(token, "店舗名をもう一度送ってください。")
-                return
-            if step == 'ask_seats':
-                resp = client.models.generate_content(
-                    model=MODEL_TEXT,
-                    contents=types.Content(parts=[
-                        types.Part.from_text(text=(
-                            f"以下の文から座席数を抽出し、形式「1人席:◯ 2人席:◯ 4人席:◯」で出力してください：\n{text}"
-                        ))
-                    ]),
-                    config=types.GenerateContentConfig(max_output_tokens=128)
-                )
-                seat_info = resp.text.strip()
-                st.update({'step': 'confirm_seats', 'seat_info': seat_info})
-                _line_reply(token, f"座席数確認：{seat_info}\nこの内容で登録しますか？（はい／いいえ）")
-                return
-            if step == 'confirm_seats':
-                if 'はい' in text:
-                    st['step'] = 'wait_template_img'
-                    _line_reply(token, 'テンプレート画像をお送りください。解析後にシートを作成します。')
-                else:
-                    st['step'] = 'ask_seats'
-                    _line_reply(token, '座席数を再度入力してください。')
-                return
-            if step == 'confirm_template':
-                if 'はい' in text:
-                    _line_reply(token, 'シートを作成中です…')
-                    times = _vision_extract_times(st['template_img'])
-                    url = create_store_sheet(
-                        st['store_name'], st['store_id'], st['seat_info'], times
-                    )
-                    st.update({'step': 'wait_filled_img', 'sheet_url': url})
-                    _line_push(uid, f"✅ シート作成完了！ {url}\n記入済みの画像を送ってください。")
-                else:
-                    st.update({'step': 'wait_template_img'})
-                    _line_reply(token, 'テンプレート画像を再度お送りください。')
-                return
+            on_text = TEXT_STEPS.get(step)
+            if on_text:
+                await on_text(uid, token, st, msg.get("text", ""))
+            return
         if mtype == 'image':
-            if step == 'wait_template_img':
-                threading.Thread(target=_process_template, args=(uid, msg_id)).start()
-                _line_reply(token, '画像を受信しました。解析中…')
-                return
-            if step == 'wait_filled_img':
-                threading.Thread(target=_process_filled, args=(uid, msg_id)).start()
-                _line_reply(token, '画像を受信しました。予約情報を抽出中…')
+            if step in IMAGE_STEPS:
+                ack, job = IMAGE_STEPS[step]
+                _spawn(_reply_with_result(uid, token, ack, job, uid, msg.get("id", "")))
                 return
-            _line_reply(token, '現在この画像は処理できません。')
+            await _line_reply(token, MSG_IMAGE_UNEXPECTED)
     except Exception as e:
-        print(f"[handle_event error] {e}")
-        _line_reply(event.get('replyToken', ''), '内部エラーが発生しました。再度お試しください。')
+        log.warning("[handle_event error] %s", e)
+        await _line_reply(event.get('replyToken', ''), MSG_INTERNAL_ERROR)
+
+SEEN_EVENTS_MAX = 10_000
+_seen_events: OrderedDict[str, None] = OrderedDict()  # ループ上でだけ触る
+
+def _seen_event(event_id: str) -> bool:
+    """LINE の再送で同じ webhookEventId が届いたら True（処理済み扱い）"""
+    if not event_id:
+        return False
+    if event_id in _seen_events:
+        _seen_events.move_to_end(event_id)
+        return True
+    _seen_events[event_id] = None
+    if len(_seen_events) > SEEN_EVENTS_MAX:
+        _seen_events.popitem(last=False)
+    return False
+
+async def _handle_events(events: List[Dict[str, Any]]) -> None:
+    """events は同じユーザーのもの。Redis 利用時は別ワーカーに届いた同じユーザーのイベントと状態の更新が交錯しないよう直列化する"""
+    if not REDIS_URL:
+        for ev in events:
+            await _handle_event(ev)
+        return
+    from redis.exceptions import LockError
+    uid = events[0].get('source', {}).get('userId', '')
+    done = 0
+    try:
+        async with _user_lock(uid):
+            for ev in events:
+                await _handle_event(ev)
+                done += 1
+    except LockError as e:
+        # 処理済みとして記録したので LINE は再送しない。黙って捨てず、処理できなかった分に返信しておく
+        log.warning("[_handle_events] lock error uid=%s error=%s", uid, e)
+        for ev in events[done:]:
+            await _line_reply(ev.get('replyToken', ''), MSG_INTERNAL_ERROR)
 
 @app.route('/', methods=['GET', 'HEAD', 'POST'])
-def webhook() -> tuple[str, int]:
+async def webhook() -> tuple[str, int]:
     if request.method in ('GET', 'HEAD'):
         return 'OK', 200
-    body = request.get_json(force=True, silent=True) or {}
-    events = body.get('events', [])
+    try:
+        body = orjson.loads(await request.get_data(cache=False))
+    except ValueError:  # orjson.JSONDecodeError も ValueError
+        body = None
+    if not isinstance(body, dict):
+        return 'BADREQUEST', 200
+    events = body.get('events')
+    if not isinstance(events, list):
+        return 'BADREQUEST', 200
+    # 返信できるメッセージイベント以外（follow / unfollow / postback など）や壊れた要素はタスクも作らない
+    events = [
+        ev for ev in events
+        if isinstance(ev, dict) and ev.get('type') == 'message' and ev.get('replyToken')
+        and isinstance(ev.get('source'), dict)
+    ]
     if not events:
         return 'NOEVENT', 200
-    threading.Thread(target=_handle_event, args=(events[0],)).start()
+    if len(_tasks) > MAX_PENDING_EVENTS:
+        # 重複の記録（_seen_event）より前に断るので、再送されたイベントは処理済み扱いにならない
+        log.warning("[webhook] queue full, asking LINE to redeliver")
+        return 'BUSY', 503
+    # 同じユーザーのイベントは順番どおりに、ユーザーごとには並列に処理する
+    by_user: Dict[str, List[Dict[str, Any]]] = {}
+    for ev in events:
+        if _seen_event(ev.get('webhookEventId', '')):
+            continue
+        uid = ev['source'].get('userId', '')
+        by_user.setdefault(uid, []).append(ev)
+    for evs in by_user.values():
+        _spawn(_handle_events(evs))
     return 'OK', 200
 
+SHUTDOWN_GRACE_SEC = 20  # 停止時に処理中の返信や解析を待つ上限（MASTER_STOP_SEC と合わせて gunicorn の graceful_timeout より短く）
+
+@app.after_serving
+async def _drain_tasks() -> None:
+    """再デプロイ時に処理中の画像解析や返信を途中で捨てないよう、少しだけ待ってから接続を閉じる"""
+    # 処理中のイベントが画像解析などを新たに _spawn することがあるので、空になるまで待ち直す
+    deadline = time.monotonic() + SHUTDOWN_GRACE_SEC
+    while _tasks:
+        left = deadline - time.monotonic()
+        if left <= 0:
+            log.warning("[_drain_tasks] giving up on %s tasks", len(_tasks))
+            break
+        log.info("[_drain_tasks] waiting for %s tasks", len(_tasks))
+        await asyncio.wait(set(_tasks), timeout=left, return_when=asyncio.FIRST_COMPLETED)
+    await asyncio.to_thread(_stop_master_flusher, MASTER_STOP_SEC)  # 店舗登録の書き込み待ちを失わない
+    await _line_aio().aclose()
+
 if __name__ == '__main__':
     # ===== 以下はスプレッドシート自動作成テスト用コード =====
     # テスト用の店舗情報でシートを自動生成します。不要なら削除してください。
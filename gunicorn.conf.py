@@ -0,0 +1,20 @@
+# gunicorn.conf.py
+#
+# 起動コマンド（Render の Start Command / Procfile）:
+#   gunicorn -c gunicorn.conf.py app:app
+#
+# app は Quart（ASGI）なので uvicorn のワーカーで動かす。1 ワーカー = 1 イベントループで、
+# 同時リクエストはループ上のタスクとして捌く（リクエストごとのスレッドは持たない）。
+# uvicorn[standard] を入れておくと、ループは uvloop、HTTP の解析は httptools が自動で使われる。
+# REDIS_URL を設定しない場合は会話状態をプロセス内に保持するため workers は 1 のまま。
+# Redis を使うなら WEB_CONCURRENCY を増やしてよい。
+import os
+
+bind = f"0.0.0.0:{os.environ.get('PORT', '5000')}"
+worker_class = "uvicorn.workers.UvicornWorker"
+workers = int(os.environ.get("WEB_CONCURRENCY", "1"))
+timeout = 60
+keepalive = 5
+# master で app.py を 1 回だけ import してからワーカーを fork する（import 済みのモジュールを共有）。
+# スレッドや接続は import 時には作らず、各ワーカーの起動時（before_serving）や初回利用時に作ること。
+preload_app = True